@@ -2,20 +2,63 @@
 application or as an AWS Lambda pair."""
 
 import argparse
+import concurrent.futures
+import functools
+import html
+import io
 import json
 import os
 import re
 import shlex
 import sys
+import time
 import traceback
 import urllib.parse
-import urllib.request
 
-import boto3
-import bs4
+# boto3, PIL, and slackclient are imported by the functions that need them, so
+# the dispatch lambda doesn't pay for the processing lambda's imports on a cold
+# start, and vice versa.
 import requests
-import slackclient
-import wand.image
+import requests.adapters
+import urllib3.util.retry
+
+# Slack's limits on custom emoji images, and the formats it accepts as-is.
+EMOJI_SIZE = 128
+MAX_EMOJI_BYTES = 64 * 1024
+UPLOAD_FORMATS = ('PNG', 'GIF', 'JPEG')
+
+# The palette index used for transparent pixels in resized animated GIFs.
+_GIF_TRANSPARENT_INDEX = 255
+
+# All Slack HTTPS traffic goes through a single pooled session so that repeated
+# calls reuse the same keep-alive connection instead of redoing the DNS lookup,
+# TCP connect, and TLS handshake every time.
+_SLACK_SESSION = requests.Session()
+_SLACK_SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=urllib3.util.retry.Retry(total=3, backoff_factor=0.2)))
+
+# The login crumb lives in the JSON data-props attribute of the element with id
+# props_node. These pull that attribute out of the login page without parsing
+# the whole document.
+_PROPS_NODE_ID_RE = re.compile(r'\sid="props_node"')
+_DATA_PROPS_RE = re.compile(r'\sdata-props="([^"]*)"')
+_API_TOKEN_RE = re.compile(r'"api_token":"([a-z0-9-]+)"')
+
+# Maps (url, email, password) to a (timestamp, SlackClient) tuple, so a warm
+# Lambda container doesn't log in again for every command.
+_SLACK_CLIENT_CACHE = {}
+_SLACK_CLIENT_TTL = 3600
+
+# Slack API errors meaning the token is no longer any good.
+_AUTH_ERRORS = ('invalid_auth', 'not_authed', 'token_revoked',
+                'account_inactive')
+
+# Maps a Slack API token to a (timestamp, emoji dict) tuple holding the last
+# emoji.list response, so back-to-back existence checks skip the round-trip.
+_EMOJI_LIST_CACHE = {}
+_EMOJI_LIST_TTL = 600
 
 class ArgumentParser(argparse.ArgumentParser):
     """Make a subclass of argparse.ArgumentParser to override the stupid
@@ -29,101 +72,272 @@ class ArgumentParser(argparse.ArgumentParser):
             raise exc
         raise Exception('Error: {}'.format(message))
 
-def square_crop_and_resize(image, size):
-    """Crops an image to be square by removing pixels evenly from both sides of
-    the longest side of the image. Then the image is resized to the desired
-    size"""
-
-    # Calculate how much longer the longest side is than the shortest.
-    extra = max(image.width, image.height) - min(image.width, image.height)
-
-    # Remove pixels evenly from the left or top.
-    rem_lt = extra // 2
+    def print_help(self, file=None):
+        """Raise the help text instead of printing it, so a slash-command like
+        'add -h' can send it back to the user."""
+        raise Exception(self.format_help())
 
-    # Remove pixels evenly from the right or bottom. We may need to take
-    # another single pixel from one side if there is an uneven number of pixels
-    # to split between the two sides.
-    rem_rb = rem_lt + extra % 2
-
-    # Crop the image centered so the image is square.
-    if image.width > image.height:
-        image.crop(rem_lt, 0, image.width - rem_rb - 1, image.height - 1)
-    else:
-        image.crop(0, rem_lt, image.width - 1, image.height - rem_rb - 1)
-    assert image.width == image.height
-
-    image.resize(size, size)
+    def exit(self, status=0, message=None):
+        """Raise an exception instead of terminating."""
+        raise Exception(message or 'Error: exited with status {}'.format(
+            status))
+
+class SlackAuthError(Exception):
+    """Raised when Slack rejects our API token, e.g. because the login that
+    produced it has expired."""
+
+def _check_response(response, method):
+    """Raises an exception if a Slack API response isn't ok, using a
+    SlackAuthError if the token was rejected."""
+    if response.get('error') in _AUTH_ERRORS:
+        raise SlackAuthError('Slack rejected the token: ' + response['error'])
+    if not response.get('ok'):
+        raise Exception('failed to call {}: {}'.format(
+            method, response.get('error', 'unknown error')))
 
-def get_slack_client(url, email, password):
-    """Instantiates a SlackClient using a token we get through login."""
+def square_crop_and_resize(image, size):
+    """Crops an image to be square by removing pixels evenly from both sides of
+    the longest side of the image, and resizes it to the desired size. Both
+    happen in a single pass, and the result is returned as a new image."""
+    import PIL.Image
+    import PIL.ImageOps
+    return PIL.ImageOps.fit(image, (size, size), PIL.Image.LANCZOS)
+
+def _find_crumb(page):
+    """Finds the login crumb in the data-props attribute of the props_node
+    element on the Slack login page."""
+
+    props = None
+    props_node_id = _PROPS_NODE_ID_RE.search(page)
+    if props_node_id:
+        tag_start = page.rfind('<', 0, props_node_id.start())
+        tag_end = page.find('>', props_node_id.end())
+        if tag_start >= 0 and tag_end >= 0:
+            props = _DATA_PROPS_RE.search(page[tag_start:tag_end])
+    if not props:
+        raise Exception('failed to find the login crumb')
+    return json.loads(html.unescape(props.group(1)))['crumbValue']
+
+def _login(url, email, password, session):
+    """Logs in to Slack on the given session and returns the API token."""
 
-    session = requests.session()
     response = session.get(url)
     response.raise_for_status()
-    soup = bs4.BeautifulSoup(response.text, "html.parser")
-    crumb = json.loads(soup.find(id='props_node')['data-props'])['crumbValue']
     data = {'signin': 1,
             'redir': '/customize/emoji',
-            'crumb': crumb,
+            'crumb': _find_crumb(response.text),
             'remember': 'on',
             'email': email,
             'password': password}
     response = session.post(url, data=data)
     response.raise_for_status()
-    api_token_regex = re.compile('"api_token":"([a-z0-9-]*)",')
-    api_token = api_token_regex.search(response.text).groups()[0]
-    return slackclient.SlackClient(api_token)
-
-def get_slack_client_from_env():
+    api_token_match = _API_TOKEN_RE.search(response.text)
+    if not api_token_match:
+        raise Exception('failed to find the api token, check the login')
+    return api_token_match.group(1)
+
+def get_slack_client(url, email, password, session=None, refresh=False):
+    """Instantiates a SlackClient using a token we get through login. The
+    login uses the given requests session, or a shared pooled one by default.
+    A given session is used as-is, so it must not already be logged in. Logins
+    on the shared session are cached and reused for later calls with the same
+    credentials, unless refresh is set or the cached login is too old."""
+    import slackclient
+
+    if session is not None:
+        return slackclient.SlackClient(_login(url, email, password, session))
+
+    key = (url, email, password)
+    cached = _SLACK_CLIENT_CACHE.get(key)
+    if (cached and not refresh
+            and time.time() - cached[0] < _SLACK_CLIENT_TTL):
+        return cached[1]
+
+    # Start the shared session from a clean cookie jar, otherwise a previous
+    # login would skip the sign-in form we need to scrape the crumb from.
+    _SLACK_SESSION.cookies.clear()
+    client = slackclient.SlackClient(
+        _login(url, email, password, _SLACK_SESSION))
+    _SLACK_CLIENT_CACHE[key] = (time.time(), client)
+    return client
+
+def get_slack_client_from_env(refresh=False):
     """Instantiates a slack client using a team name, email, and password
     retreived from environment variables."""
 
     url = 'https://{}.slack.com'.format(os.environ['EMOJIFY_TEAM_NAME'])
     email = os.environ['EMOJIFY_EMAIL']
     password = os.environ['EMOJIFY_PASSWORD']
-    return get_slack_client(url, email, password)
+    return get_slack_client(url, email, password, refresh=refresh)
 
-def assert_emoji(client, exists=None, not_exists=None):
-    """Makes sure a particular emoji exists and/or does not exist."""
+def _get_emoji_list(client, ttl=_EMOJI_LIST_TTL):
+    """Gets the dict of custom emojis, reusing the cached emoji.list response
+    if it is less than ttl seconds old."""
 
+    cached = _EMOJI_LIST_CACHE.get(client.token)
+    if cached and time.time() - cached[0] < ttl:
+        return cached[1]
     emojis = client.api_call('emoji.list')
-    if 'ok' not in emojis or not emojis['ok'] or 'emoji' not in emojis:
+    _check_response(emojis, 'emoji.list')
+    if 'emoji' not in emojis:
         raise Exception('failed to call emoji.list')
-    if exists and exists not in emojis['emoji']:
-        raise Exception('Emoji {} does not exist.'.format(exists))
-    if not_exists and not_exists in emojis['emoji']:
-        raise Exception('Emoji {} already exists.'.format(not_exists))
-
-def add_emoji(client, image, name):
-    """Uploads an image file as an emoji to Slack. The image is expected to be
-    at most 128x128 and 64k."""
+    _EMOJI_LIST_CACHE[client.token] = (time.time(), emojis['emoji'])
+    return emojis['emoji']
+
+def _update_emoji_list(client, name, value=None):
+    """Keeps the cached emoji list in sync after a successful change, adding
+    the emoji if a value is given or removing it otherwise. Removing an emoji
+    also removes its aliases, just like Slack does."""
+
+    cached = _EMOJI_LIST_CACHE.get(client.token)
+    if not cached:
+        return
+    if value is None:
+        cached[1].pop(name, None)
+        for alias in [alias for alias, target in cached[1].items()
+                      if target == 'alias:' + name]:
+            del cached[1][alias]
+    else:
+        cached[1][name] = value
+
+def check_emoji(client, must_exist=(), must_not_exist=()):
+    """Makes sure every emoji in must_exist exists and every emoji in
+    must_not_exist does not, using a single emoji.list lookup for all of
+    them. The error names every emoji that failed a check."""
+
+    def passes(emojis):
+        """Whether the emoji names pass every check."""
+        return emojis.issuperset(must_exist) and emojis.isdisjoint(
+            must_not_exist)
+
+    emojis = set(_get_emoji_list(client))
+    if passes(emojis):
+        return
+    # The cached list may be stale, e.g. if the emoji was changed from another
+    # container or in Slack itself, so make sure with a fresh one.
+    emojis = set(_get_emoji_list(client, ttl=0))
+    if passes(emojis):
+        return
+    errors = ['Emoji {} does not exist.'.format(name)
+              for name in must_exist if name not in emojis]
+    errors += ['Emoji {} already exists.'.format(name)
+               for name in must_not_exist if name in emojis]
+    raise Exception(' '.join(errors))
+
+def upload_emoji(client, data, mimetype, name):
+    """Uploads already-encoded image bytes as an emoji to Slack. The image is
+    expected to be at most 128x128 and 64k."""
 
     # Use requests rather than the slack client because the syntax to make the
     # SlackClient upload the image is unclear.
-    assert_emoji(client, not_exists=name)
-    data = {'mode': 'data', 'name': name, 'token': client.token}
-    files = {'image': ('emoji_filename', image.make_blob(), image.mimetype)}
-    response = requests.post('https://slack.com/api/emoji.add',
-                             data=data,
-                             files=files)
+    check_emoji(client, must_not_exist=(name,))
+    form = {'mode': 'data', 'name': name, 'token': client.token}
+    files = {'image': ('emoji_filename', data, mimetype)}
+    response = _SLACK_SESSION.post('https://slack.com/api/emoji.add',
+                                   data=form,
+                                   files=files)
+    if response.status_code in (401, 403):
+        raise SlackAuthError('Slack rejected the token: HTTP {}'.format(
+            response.status_code))
     response.raise_for_status()
+    _check_response(response.json(), 'emoji.add')
+    # The image URL isn't returned, but only the name matters for checks.
+    _update_emoji_list(client, name, '')
+
+def _quantize_frame(frame):
+    """Quantizes an RGBA frame to a palette image for a GIF. Mostly transparent
+    pixels all use the last palette index, which is reserved for them."""
+    image = frame.convert('RGB').quantize(colors=_GIF_TRANSPARENT_INDEX)
+    palette = image.getpalette()[:_GIF_TRANSPARENT_INDEX * 3]
+    image.putpalette(palette + [0] * (768 - len(palette)))
+    image.paste(_GIF_TRANSPARENT_INDEX,
+                mask=frame.getchannel('A').point(lambda a: 255 * (a < 128)))
+    return image
+
+def encode_emoji(image, size):
+    """Crops and resizes a PIL image to a size by size square, returning the
+    encoded bytes and their mimetype. Animated GIFs keep all of their frames
+    and JPEGs stay JPEGs. Everything else is encoded as a PNG."""
+    import PIL.ImageSequence
+    buf = io.BytesIO()
+    if image.format == 'GIF' and getattr(image, 'n_frames', 1) > 1:
+        options = {'loop': image.info['loop']} if 'loop' in image.info else {}
+        frames = []
+        durations = []
+        for frame in PIL.ImageSequence.Iterator(image):
+            durations.append(frame.info.get('duration', 100))
+            frames.append(_quantize_frame(
+                square_crop_and_resize(frame.convert('RGBA'), size)))
+        # Older Pillows lose the transparency when the GIF writer converts
+        # RGBA frames or optimizes their palettes, so the frames are quantized
+        # above and their palettes are left alone.
+        frames[0].save(buf,
+                       format='GIF',
+                       save_all=True,
+                       append_images=frames[1:],
+                       duration=durations,
+                       disposal=2,
+                       optimize=False,
+                       transparency=_GIF_TRANSPARENT_INDEX,
+                       **options)
+        return buf.getvalue(), 'image/gif'
+    if image.format == 'JPEG':
+        square_crop_and_resize(image.convert('RGB'), size).save(
+            buf, format='JPEG', quality=90, optimize=True)
+        return buf.getvalue(), 'image/jpeg'
+    square_crop_and_resize(image.convert('RGBA'), size).save(
+        buf, format='PNG', optimize=True)
+    return buf.getvalue(), 'image/png'
+
+def add_emoji(client, image, name):
+    """Crops and resizes a PIL image into an emoji and uploads it to Slack."""
+    data, mimetype = encode_emoji(image, EMOJI_SIZE)
+    upload_emoji(client, data, mimetype, name)
 
 def remove_emoji(client, name):
     """Deletes an emoji by name."""
-    assert_emoji(client, exists=name)
-    client.api_call('emoji.remove', name=name)
+    check_emoji(client, must_exist=(name,))
+    response = client.api_call('emoji.remove', name=name)
+    _check_response(response, 'emoji.remove')
+    _update_emoji_list(client, name)
 
 def alias_emoji(client, target, alias):
     """Aliases an emoji such that alias is the same emoji as target."""
-    assert_emoji(client, exists=target, not_exists=alias)
-    client.api_call('emoji.add', mode='alias', name=alias, alias_for=target)
-
-def handle_add(client, args):
-    """Handle a create command, which has 'url' and 'name' arguments."""
-    image_file = urllib.request.urlopen(args.url)
-    with wand.image.Image(file=image_file) as image:
-        square_crop_and_resize(image, 128)
-        add_emoji(client, image, args.name)
+    check_emoji(client, must_exist=(target,), must_not_exist=(alias,))
+    response = client.api_call('emoji.add',
+                               mode='alias',
+                               name=alias,
+                               alias_for=target)
+    _check_response(response, 'emoji.add')
+    _update_emoji_list(client, alias, 'alias:' + target)
+
+def download_image(url):
+    """Downloads an image, returning its raw bytes. This deliberately doesn't
+    use the Slack session: the URL comes from the user, and it shouldn't see
+    the Slack login cookies or share a session with the login thread."""
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.content
+
+def handle_add(client, args, image_data=None):
+    """Handle a create command, which has 'url' and 'name' arguments. If the
+    image has already been downloaded its bytes can be given as image_data."""
+    import PIL.Image
+    if image_data is None:
+        image_data = download_image(args.url)
+    with PIL.Image.open(io.BytesIO(image_data)) as image:
+        # Opening only reads the header, so if the image is already a small
+        # enough square it can be uploaded as-is without decoding it. This
+        # also keeps animated GIFs animated.
+        width, height = image.size
+        if (len(image_data) <= MAX_EMOJI_BYTES and width == height
+                and width <= EMOJI_SIZE and image.format in UPLOAD_FORMATS):
+            upload_emoji(client,
+                         image_data,
+                         PIL.Image.MIME[image.format],
+                         args.name)
+        else:
+            add_emoji(client, image, args.name)
     return 'Created emoji {0} :{0}:'.format(args.name)
 
 def handle_remove(client, args):
@@ -136,26 +350,49 @@ def handle_alias(client, args):
     alias_emoji(client, args.target, args.alias)
     return 'Aliased emoji {} links to {}'.format(args.alias, args.target)
 
+# Every slash-command, mapped to its positional arguments and handler.
+_COMMANDS = {
+    'add': (('name', 'url'), handle_add),
+    'remove': (('name',), handle_remove),
+    'alias': (('target', 'alias'), handle_alias),
+}
+
+def _build_parser():
+    """Build the parser for the slack slash-command command-line arguments."""
+    parser = ArgumentParser(prog='emojify')
+    subparsers = parser.add_subparsers()
+    for command, (arguments, handler) in _COMMANDS.items():
+        command_parser = subparsers.add_parser(command)
+        for argument in arguments:
+            command_parser.add_argument(argument)
+        command_parser.set_defaults(func=handler)
+    return parser
+
+# Parsing doesn't modify the parser, so build it once and reuse it across warm
+# Lambda invocations.
+_PARSER = _build_parser()
+
 def parse_command_line(cmdline=None):
     """Parse the slack slash-command command-line arguments."""
-    parser = ArgumentParser()
-    subparsers = parser.add_subparsers()
-    create_parser = subparsers.add_parser('add')
-    create_parser.add_argument('name')
-    create_parser.add_argument('url')
-    create_parser.set_defaults(func=handle_add)
-    delete_parser = subparsers.add_parser('remove')
-    delete_parser.add_argument('name')
-    delete_parser.set_defaults(func=handle_remove)
-    alias_parser = subparsers.add_parser("alias")
-    alias_parser.add_argument('target')
-    alias_parser.add_argument('alias')
-    alias_parser.set_defaults(func=handle_alias)
-    if cmdline:
-        args = parser.parse_args(shlex.split(cmdline))
-    else:
-        args = parser.parse_args()
-    return args
+    return _PARSER.parse_args(shlex.split(cmdline) if cmdline else None)
+
+def run_command(args):
+    """Logs in and runs a parsed command, logging in again once if Slack
+    rejects a cached login. Any image the command needs is downloaded while
+    the login is still in flight, since the two are independent."""
+    func = args.func
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        client = executor.submit(get_slack_client_from_env)
+        if func is handle_add:
+            image_data = executor.submit(download_image, args.url)
+            func = functools.partial(handle_add,
+                                     image_data=image_data.result())
+        client = client.result()
+    try:
+        return func(client, args)
+    except SlackAuthError:
+        # The cached login has expired, so log in again and retry once.
+        return func(get_slack_client_from_env(refresh=True), args)
 
 def emojify(event, _):
     """Entry point for the lambda that actually does the processing."""
@@ -171,19 +408,27 @@ def emojify(event, _):
         print('COMMAND LINE: ' + message['command'])
         args = parse_command_line(message['command'])
         print('COMMAND BEGIN')
-        success_message = '{}, thanks <@{}>!'.format(
-            args.func(get_slack_client_from_env(), args), user_id)
+        success_message = '{}, thanks <@{}>!'.format(run_command(args),
+                                                     user_id)
         print('COMMAND COMPLETE: ' + success_message)
-        requests.post(response_url,
-                      data=json.dumps({'text': success_message,
-                                       'response_type': 'in_channel'}))
+        _SLACK_SESSION.post(response_url,
+                            data=json.dumps({'text': success_message,
+                                             'response_type': 'in_channel'}))
     # pylint: disable=broad-except
     except Exception as exc:
         print('COMMAND ERROR: ' + str(exc))
         traceback.print_exc()
-        requests.post(response_url, data=json.dumps({'text': str(exc)}))
+        _SLACK_SESSION.post(response_url, data=json.dumps({'text': str(exc)}))
     # pylint: enable=broad-except
 
+@functools.lru_cache(maxsize=None)
+def get_sns_client():
+    """Creates the SNS client once per container. Building a boto3 client
+    resolves credentials and loads service models, which is too slow to redo
+    on every request."""
+    import boto3
+    return boto3.client('sns')
+
 def dispatch(event, _):
     """Entry point for the initial lambda. Just posts so an SNS topic to invoke
     the lambda that actually does the work. This is annoying, but the
@@ -214,10 +459,12 @@ def dispatch(event, _):
         command = params['text'][0]
         print('DISPATCH COMMAND: ' + command)
 
-        # Parse the command-line arguments here even though the next lambda
-        # also parses them. This allows us to respond immediately to ill-formed
-        # commands.
-        parse_command_line(command)
+        # Check the command name here so we can respond immediately to unknown
+        # commands. Full argument parsing is left to the next lambda, where it
+        # doesn't count against slack's response time limit.
+        verb = shlex.split(command)[:1]
+        if not verb or verb[0] not in _COMMANDS:
+            raise Exception('Error: unknown command "{}"'.format(command))
 
         # Publish an SNS notification to invoke the second-state lambda.
         message = {
@@ -225,7 +472,10 @@ def dispatch(event, _):
             "user_id": params['user_id'][0],
             "command": command
         }
-        response = boto3.client('sns').publish(
+        # Wait for the publish to finish even though slack only needs the
+        # response. Lambda freezes the container once we return, so a publish
+        # left running in the background could be silently lost.
+        response = get_sns_client().publish(
             TopicArn=os.environ['EMOJIFY_SNS_TOPIC'],
             Message=json.dumps({'default': json.dumps(message)}),
             MessageStructure='json'
@@ -242,8 +492,13 @@ def dispatch(event, _):
 
 def main():
     """Process the command given on the command line."""
-    args = parse_command_line()
-    print(args.func(get_slack_client_from_env(), args))
+    # pylint: disable=broad-except
+    try:
+        args = parse_command_line()
+    except Exception as exc:
+        sys.exit(str(exc))
+    # pylint: enable=broad-except
+    print(run_command(args))
 
 if __name__ == '__main__':
     main()